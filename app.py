@@ -1,16 +1,39 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import xxhash
+import requests
+from requests.adapters import HTTPAdapter
 from groq import Groq
-import plotly.express as px
-import gspread
-from serpapi import GoogleSearch
-from google.oauth2 import service_account
+import io
 import os
+import re
+import warnings
 from dotenv import load_dotenv
+from pandas.tseries.api import guess_datetime_format
 
 # Load environment variables
 load_dotenv()
 
+# Seconds to wait for SerpAPI before answering without web results
+SEARCH_TIMEOUT = 10
+
+SERPAPI_URL = "https://serpapi.com/search.json"
+
+# Longer snippets only add prompt tokens
+MAX_SNIPPET_CHARS = 300
+
+# Completion budget: short questions rarely need long answers
+SHORT_QUESTION_CHARS = 80
+SHORT_ANSWER_TOKENS = 512
+LONG_ANSWER_TOKENS = 1024
+
+HISTOGRAM_BINS = 50
+
+# Answer cache: questions at least this similar to an earlier one reuse its answer
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
 @st.cache_resource
 def get_groq_client():
     api_key = os.getenv("GROQ_API_KEY")
@@ -19,128 +42,393 @@ def get_groq_client():
         st.stop()
     return Groq(api_key=api_key)
 
+@st.cache_resource
+def get_http_session():
+    """Shared keep-alive session so repeat searches reuse the TLS connection"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
 def web_search(query, num_results=3):
-    """Perform web search using SerpAPI with debug output"""
+    """Perform web search using SerpAPI, memoized per (query, num_results)"""
+    api_key = os.getenv("SERPAPI_KEY")
+    if not api_key:
+        raise ValueError("SERPAPI_KEY not found in environment variables")
+    
+    response = get_http_session().get(SERPAPI_URL, params={
+        "q": query,
+        "api_key": api_key,
+        "num": num_results,
+        "engine": "google"  # Explicitly set engine
+    }, timeout=SEARCH_TIMEOUT)
+    
     try:
-        api_key = os.getenv("SERPAPI_KEY")
-        if not api_key:
-            st.error("SERPAPI_KEY not found in environment variables")
-            return []
-            
-        st.info(f"Searching for: {query}")  # Debug info
-        
-        search = GoogleSearch({
-            "q": query,
-            "api_key": api_key,
-            "num": num_results,
-            "engine": "google"  # Explicitly set engine
+        results = response.json()
+    except ValueError:
+        # Not JSON (e.g. an HTML error page), report the HTTP status instead
+        response.raise_for_status()
+        raise RuntimeError(f"Unexpected non-JSON response from SerpAPI (HTTP {response.status_code})")
+    if "error" in results:
+        # Raise rather than return so API errors are not memoized
+        raise RuntimeError(results["error"])
+    response.raise_for_status()
+    
+    search_results = []
+    for result in results.get("organic_results", [])[:num_results]:
+        search_results.append({
+            "title": result.get("title", ""),
+            "snippet": result.get("snippet", ""),
+            "link": result.get("link", "")
         })
-        
-        results = search.get_dict()
-        
-        if "organic_results" not in results:
-            st.warning("No organic results found in API response")
-            return []
-            
-        search_results = []
-        for result in results["organic_results"][:num_results]:
-            search_results.append({
-                "title": result.get("title", ""),
-                "snippet": result.get("snippet", ""),
-                "link": result.get("link", "")
-            })
-            
-        st.info(f"Found {len(search_results)} results")  # Debug info
-        st.write(search_results)  # Debug info
-        return search_results
+    return search_results
 
-        
-    except Exception as e:
-        st.error(f"Search error: {str(e)}")
-        return []
+@st.cache_resource
+def get_gspread_client():
+    # Imported here so CSV-only sessions never load the Google client libraries
+    import gspread
+    from google.oauth2 import service_account
+    
+    credentials = service_account.Credentials.from_service_account_info(
+        st.secrets["gcp_service_account"],
+        scopes=['https://spreadsheets.google.com/feeds',
+               'https://www.googleapis.com/auth/spreadsheets',
+               'https://www.googleapis.com/auth/drive']
+    )
+    return gspread.authorize(credentials)
 
 def setup_google_auth():
     try:
-        credentials = service_account.Credentials.from_service_account_info(
-            st.secrets["gcp_service_account"],
-            scopes=['https://spreadsheets.google.com/feeds',
-                   'https://www.googleapis.com/auth/spreadsheets',
-                   'https://www.googleapis.com/auth/drive']
-        )
-        return gspread.authorize(credentials)
+        return get_gspread_client()
     except Exception as e:
         st.error(f"Google Sheets authentication failed: {str(e)}")
         return None
 
+@st.cache_data(ttl=600, show_spinner=False)
+def _load_sheet(url):
+    """Fetch and summarize the first worksheet, memoized per sheet URL"""
+    sheet = get_gspread_client().open_by_url(url)
+    worksheet = sheet.get_worksheet(0)
+    # Raw cell values avoid gspread building a dict per row
+    values = worksheet.get_all_values()
+    if not values:
+        return process_data(pd.DataFrame())
+    header = values[0]
+    if any(not name.strip() for name in header):
+        raise ValueError("The header row has blank cells; give every column a name.")
+    duplicates = sorted({name for name in header if header.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"The header row is not unique: {', '.join(duplicates)}")
+    df = pd.DataFrame(values[1:], columns=header).replace("", None)
+    for col in df.columns:
+        try:
+            df[col] = pd.to_numeric(df[col])
+        except (ValueError, TypeError):
+            pass
+    return process_data(to_arrow_dtypes(df))
+
 def load_google_sheet(url):
     try:
-        gc = setup_google_auth()
-        if gc:
-            sheet = gc.open_by_url(url)
-            worksheet = sheet.get_worksheet(0)
-            data = worksheet.get_all_records()
-            df = pd.DataFrame(data)
-            return process_data(df)
+        if not setup_google_auth():
+            return None, None
+        df, stats = _load_sheet(url)
     except Exception as e:
         st.error(f"Error loading Google Sheet: {str(e)}")
         return None, None
+    if df is None:
+        st.error("The data is empty.")
+    return df, stats
+
+def to_arrow_dtypes(df):
+    """Switch to pyarrow-backed dtypes, keeping NumPy dtypes if pyarrow is unavailable"""
+    try:
+        return df.convert_dtypes(dtype_backend="pyarrow")
+    except (ImportError, TypeError, ValueError):
+        return df
+
+def _read_csv_chunks(buffer, max_rows=None, chunksize=500_000):
+    """Read a CSV, keeping at most max_rows rows; returns (df, truncated)
+
+    With a limit the file is streamed in chunks and parsing stops once max_rows rows
+    are kept. Without one a single read is used, holding chunks for a final concat
+    would only raise peak memory.
+    """
+    if max_rows is None:
+        return pd.read_csv(buffer, engine='c'), False
+    
+    kept, kept_rows, truncated = [], 0, False
+    with pd.read_csv(buffer, engine='c', chunksize=chunksize) as reader:
+        while kept_rows < max_rows:
+            size = min(chunksize, max_rows - kept_rows)
+            try:
+                chunk = reader.get_chunk(size)
+            except StopIteration:
+                break
+            if chunk.empty:
+                break
+            kept.append(chunk)
+            kept_rows += len(chunk)
+        else:
+            # Limit reached; peek one row only to learn whether anything was skipped
+            try:
+                truncated = not reader.get_chunk(1).empty
+            except StopIteration:
+                pass
+    if not kept:
+        return pd.DataFrame(), truncated
+    return pd.concat(kept, ignore_index=True), truncated
+
+def _parse_dates(col, sample_rows=1000):
+    """Parse a text column as dates when its values share one full date format, else None"""
+    sample = col.head(sample_rows).dropna()
+    if sample.empty:
+        return None
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # dayfirst hints, the guessed format is explicit below
+        fmt = guess_datetime_format(str(sample.iloc[0]))
+    # Partial formats like "%b" would turn month names into year-1900 timestamps
+    if fmt is None or not ("%Y" in fmt or "%y" in fmt) or "%d" not in fmt:
+        return None
+    try:
+        pd.to_datetime(sample, format=fmt)
+        return pd.to_datetime(col, format=fmt)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+def _read_csv_typed(buffer, max_rows=None):
+    """Read a CSV, then parse date columns and downcast integer columns"""
+    df, truncated = _read_csv_chunks(buffer, max_rows=max_rows)
+    
+    for col in df.select_dtypes(include=['object', 'string']).columns:
+        dates = _parse_dates(df[col])
+        if dates is not None:
+            df[col] = dates
+    
+    for col in df.select_dtypes(include='integer').columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    return to_arrow_dtypes(df), truncated
+
+@st.cache_data(show_spinner=False)
+def _parse_csv_bytes(key, _raw, max_rows=None):
+    """Parse and summarize an uploaded CSV, memoized per file contents and row limit
 
-def load_csv_data(file):
+    The bytes themselves are not hashed; the cache is keyed on their xxhash digest.
+    """
+    df, truncated = _read_csv_typed(io.BytesIO(_raw), max_rows=max_rows)
+    return process_data(df, truncated=truncated)
+
+def load_csv_data(file, max_rows=None):
     try:
-        df = pd.read_csv(file)
-        return process_data(df)
+        raw = file.getvalue()
+        df, stats = _parse_csv_bytes(xxhash.xxh3_64_hexdigest(raw), raw, max_rows)
     except Exception as e:
         st.error(f"Error loading CSV file: {str(e)}")
         return None, None
+    if df is None:
+        st.error("The data is empty.")
+    return df, stats
+
+def dataframe_fingerprint(df):
+    """Content hash identifying a dataset across reruns"""
+    digest = xxhash.xxh3_64(str(list(df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return digest.hexdigest()
 
-def process_data(df):
+def process_data(df, truncated=False):
+    """Return (df, stats), or (None, None) for empty data"""
     if df.empty:
-        st.error("The data is empty.")
         return None, None
     
     stats = {
         "columns": list(df.columns),
         "rows": len(df),
-        "summary": df.describe().to_string()
+        "truncated": truncated,  # Only the first rows of a larger file were read
+        "numeric_columns": list(df.select_dtypes(include='number').columns),
+        "describe": df.describe(),  # Cached with the data, so reruns don't rescan it
+        "fingerprint": dataframe_fingerprint(df),
     }
     return df, stats
 
+@st.cache_data(show_spinner=False)
+def histogram_bins(_df, fingerprint, column, bins=HISTOGRAM_BINS):
+    """Bin a column server-side so the chart ships bin counts instead of raw values
+
+    The frame itself is not hashed; the cache is keyed on its precomputed fingerprint.
+    """
+    counts, edges = np.histogram(_df[column].dropna().to_numpy(dtype=float), bins=bins)
+    centers = (edges[:-1] + edges[1:]) / 2
+    return centers, counts
+
+@st.cache_resource(show_spinner=False)
+def get_embedder():
+    """Local sentence embedder for the answer cache, or None when unavailable"""
+    try:
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(EMBEDDING_MODEL)
+    except Exception:
+        # Not installed or the model can't be downloaded, fall back to exact matches
+        return None
+
+def embed_question(question):
+    embedder = get_embedder()
+    if embedder is None:
+        return None
+    try:
+        return embedder.encode(question, normalize_embeddings=True).astype(np.float32)
+    except Exception:
+        return None
+
+def get_answer_cache():
+    if 'answer_cache' not in st.session_state:
+        st.session_state['answer_cache'] = {
+            "exact": {},  # (context, normalized question) -> answer
+            "keys": [],  # (context, question terms) per embedded answer
+            "answers": [],
+            "embeddings": None,  # Preallocated rows, doubled when full; the first len(answers) are used
+        }
+    return st.session_state['answer_cache']
+
+def _normalize_question(question):
+    return " ".join(question.lower().split())
+
+_NUMBER_RE = re.compile(r"(?<!\w)\d+(?:\.\d+)?(?!\w)")
+_EXTREMES = {
+    "min": "min", "minimum": "min", "lowest": "min", "smallest": "min",
+    "max": "max", "maximum": "max", "highest": "max", "largest": "max",
+}
+
+def question_terms(question, columns):
+    """Numbers, column names and min/max words in a question
+
+    Embeddings barely separate questions that differ only in these, so a semantic
+    match must agree on all of them.
+    """
+    text = question.lower()
+    numbers = frozenset(_NUMBER_RE.findall(text))
+    named_columns = frozenset(
+        str(col) for col in columns
+        if re.search(rf"(?<!\w){re.escape(str(col).lower())}(?!\w)", text)
+    )
+    extremes = frozenset(_EXTREMES[word] for word in re.findall(r"[a-z]+", text) if word in _EXTREMES)
+    return numbers, named_columns, extremes
+
+def find_cached_answer(question, context, terms):
+    """Return (answer, embedding) for the same or a semantically equivalent earlier question
+
+    answer is None on a miss; the embedding is returned so storing the new answer can reuse it.
+    """
+    cache = get_answer_cache()
+    answer = cache["exact"].get((context, _normalize_question(question)))
+    if answer:
+        # Exact repeats never pay for an embedding
+        return answer, None
+    embedding = embed_question(question)
+    if embedding is None or not cache["answers"]:
+        return None, embedding
+    
+    # Embeddings are unit length, so one matvec gives every cosine similarity
+    sims = cache["embeddings"][:len(cache["answers"])] @ embedding
+    key = (context, terms)
+    same_key = np.fromiter((k == key for k in cache["keys"]), dtype=bool, count=len(sims))
+    sims = np.where(same_key, sims, -1.0)
+    best = int(np.argmax(sims))
+    if sims[best] >= SEMANTIC_CACHE_THRESHOLD:
+        return cache["answers"][best], embedding
+    return None, embedding
+
+def store_cached_answer(question, embedding, context, terms, answer):
+    if not answer:
+        # An empty or aborted stream must not shadow the question forever
+        return
+    cache = get_answer_cache()
+    cache["exact"][(context, _normalize_question(question))] = answer
+    if embedding is None:
+        return
+    
+    count = len(cache["answers"])
+    embeddings = cache["embeddings"]
+    if embeddings is None or count == len(embeddings):
+        # Double the capacity so appends stay amortized O(1)
+        grown = np.empty((max(2 * count, 16), embedding.shape[0]), dtype=np.float32)
+        if embeddings is not None:
+            grown[:count] = embeddings
+        cache["embeddings"] = embeddings = grown
+    embeddings[count] = embedding
+    cache["keys"].append((context, terms))
+    cache["answers"].append(answer)
+
+def record_result(question, answer):
+    # Append plain rows; the DataFrame is only built when results are rendered
+    if 'results_rows' not in st.session_state:
+        st.session_state['results_rows'] = []
+    st.session_state['results_rows'].append({
+        'Question': question,
+        'Answer': answer,
+        'Timestamp': pd.Timestamp.now()
+    })
+
+def results_csv(results_df):
+    """CSV export of the results history, regenerated only after a new row is added"""
+    # The history is append-only, so its length identifies its contents
+    cached = st.session_state.get('results_csv')
+    if cached is None or cached[0] != len(results_df):
+        cached = (len(results_df), results_df.to_csv(index=False).encode())
+        st.session_state['results_csv'] = cached
+    return cached[1]
 
 def ask_about_data(client, question, df, stats, use_web_search):
     try:
-        system_context = f"""Analyzing a dataset with {stats['rows']} rows and columns: {', '.join(stats['columns'])}."""
+        context = (stats['fingerprint'], use_web_search)
+        terms = question_terms(question, stats['columns'])
+        cached_answer, embedding = find_cached_answer(question, context, terms)
+        if cached_answer:
+            st.info("Answered from an earlier, equivalent question")
+            st.write("Answer:")
+            st.write(cached_answer)
+            record_result(question, cached_answer)
+            return cached_answer
+        
+        rows = f"the first {stats['rows']}" if stats['truncated'] else stats['rows']
+        system_context = f"""Analyzing a dataset with {rows} rows and columns: {', '.join(stats['columns'])}."""
         
         if use_web_search:
             with st.spinner('Searching web...'):
-                search_results = web_search(question)
+                debug = bool(st.query_params.get("debug"))
+                if debug:
+                    st.info(f"Searching for: {question}")
+                try:
+                    search_results = web_search(question)
+                except Exception as e:
+                    st.error(f"Search error: {str(e)}")
+                    search_results = []
                 if search_results:
-                    web_context = "\n".join([f"- {r['snippet']}" for r in search_results])
+                    st.info(f"Found {len(search_results)} results")
+                    if debug:
+                        st.write(search_results)
+                    web_context = "\n".join("- " + r["snippet"][:MAX_SNIPPET_CHARS] for r in search_results)
                     system_context += f"\nWeb search results:\n{web_context}"
                 else:
                     st.warning("No web search results found")
         
-        completion = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model="llama3-8b-8192",
             messages=[
                 {"role": "system", "content": system_context},
                 {"role": "user", "content": question}
             ],
             temperature=0.7,
-            max_tokens=1024,
+            max_tokens=SHORT_ANSWER_TOKENS if len(question) <= SHORT_QUESTION_CHARS else LONG_ANSWER_TOKENS,
+            stream=True,
         )
         
-        new_result = pd.DataFrame({
-            'Question': [question],
-            'Answer': [completion.choices[0].message.content],
-            'Timestamp': [pd.Timestamp.now()]
-        })
-        
-        if 'results' not in st.session_state:
-            st.session_state['results'] = new_result
-        else:
-            st.session_state['results'] = pd.concat([st.session_state['results'], new_result], ignore_index=True)
+        # Render tokens as they arrive; write_stream returns the full text
+        st.write("Answer:")
+        answer = st.write_stream(chunk.choices[0].delta.content or "" for chunk in stream)
         
-        return completion.choices[0].message.content
+        store_cached_answer(question, embedding, context, terms, answer)
+        record_result(question, answer)
+        return answer
     except Exception as e:
         st.error(f"Error: {str(e)}")
         return None
@@ -158,8 +446,12 @@ def main():
     
     if data_source == "Upload CSV":
         uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
+        limit_rows = st.checkbox("Load only the first rows of large files", key="limit_rows_toggle")
+        max_rows = None
+        if limit_rows:
+            max_rows = int(st.number_input("Rows to load:", min_value=1000, value=100_000, step=10_000))
         if uploaded_file:
-            df, stats = load_csv_data(uploaded_file)
+            df, stats = load_csv_data(uploaded_file, max_rows)
     else:
         sheet_url = st.text_input("Enter Google Sheet URL:")
         if sheet_url:
@@ -168,8 +460,11 @@ def main():
     if df is not None and stats is not None:
         # Data Overview Section
         with st.expander("Data Preview"):
-            st.dataframe(df.head())
-            st.write(f"Total rows: {stats['rows']}")
+            st.dataframe(df.head(), use_container_width=True)
+            if stats['truncated']:
+                st.write(f"Loaded rows: {stats['rows']} (first rows of a larger file)")
+            else:
+                st.write(f"Total rows: {stats['rows']}")
             st.write("Columns:", ", ".join(stats['columns']))
         
         # Column Selection
@@ -177,18 +472,22 @@ def main():
         
         # Visualization Section
         with st.expander("Data Visualization"):
-            numeric_cols = df.select_dtypes(include=['float64', 'int64']).columns
+            numeric_cols = stats['numeric_columns']
             if len(numeric_cols) > 0:
                 numeric_column = st.selectbox("Select column for visualization", numeric_cols)
                 try:
-                    fig = px.histogram(df, x=numeric_column)
+                    import plotly.express as px  # Deferred, plotly is slow to import
+                    
+                    centers, counts = histogram_bins(df, stats['fingerprint'], numeric_column)
+                    fig = px.bar(x=centers, y=counts, labels={"x": numeric_column, "y": "count"})
+                    fig.update_layout(bargap=0)
                     st.plotly_chart(fig)
                 except Exception as e:
                     st.error(f"Error creating visualization: {str(e)}")
         
         # Statistics Section
         with st.expander("Data Statistics"):
-            st.write(df.describe())
+            st.dataframe(stats['describe'], use_container_width=True)
         
         # Q&A Section
         st.subheader("Ask Questions About Your Data")
@@ -201,22 +500,22 @@ def main():
                     answer = ask_about_data(client, question, df, stats, use_web_search)
                     if answer:
                         st.success("Response generated!")
-                        st.write("Answer:", answer)
         
-        # Initialize results DataFrame in session state if not present
-        if 'results' not in st.session_state:
-            st.session_state['results'] = pd.DataFrame()
+        # Initialize results history in session state if not present
+        if 'results_rows' not in st.session_state:
+            st.session_state['results_rows'] = []
         
         # Display results in table
         st.subheader("Analysis Results")
-        if not st.session_state['results'].empty:
-            st.dataframe(st.session_state['results'])
+        results_rows = st.session_state['results_rows']
+        if results_rows:
+            results_df = pd.DataFrame(results_rows)
+            st.dataframe(results_df, use_container_width=True)
             
             # Download CSV button
-            csv = st.session_state['results'].to_csv(index=False)
             st.download_button(
                 label="Download Results as CSV",
-                data=csv,
+                data=results_csv(results_df),
                 file_name="analysis_results.csv",
                 mime="text/csv",
                 key="download_button"